@@ -1,8 +1,11 @@
 import asyncio
 import logging
 import pickle
+import random
+import threading
+import time
 
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from inspect import cleandoc
 from queue import Queue
 
@@ -11,10 +14,20 @@ from telegram.ext import (Updater, Dispatcher,
                           ExtBot, JobQueue, PicklePersistence,
                           CommandHandler, MessageHandler, Filters)
 from telegram.utils.request import Request
+from twitchAPI import EventSubSubscriptionConflict
 
 
 logger = logging.getLogger(__name__)
 
+# twitch subscription statuses which do not call for a repair
+HEALTHY_SUBSCRIPTION_STATUSES = ("enabled", "webhook_callback_verification_pending")
+
+# resubscription is retried after 30s, then 60s, 120s, etc. up to one hour
+RESUBSCRIBE_BASE_DELAY = 30
+RESUBSCRIBE_MAX_DELAY = 3600
+# minimum number of seconds between two resubscriptions
+RESUBSCRIBE_INTERVAL = 0.5
+
 
 class LajujaBotDispatcher(Dispatcher):
     """
@@ -42,11 +55,17 @@ class LajujaBotUpdater(Updater):
         { <broadcaster_id_1> : {"subscription_id": <subscription_id_1>,
                                 "subscribers": [<chat_id_1>, <chat_id_2>, ...] },
           <broadcaster_id_2> : {...}, etc. }
+    A subscription_uuid of None means the twitch subscription is broken
+    (revoked, failed or missing), and that a resubscription job is queued for it.
     """
 
     def __init__(self, config, wh_handler):
         self.config = config
         self._wh_handler = wh_handler
+        self._subscription_lock = threading.Lock()
+        self._next_resubscription_slot = 0
+        self._conflicting_broadcasters = set()
+        self._audit_interval = int(self.config.get("SubscriptionAuditInterval", 300))
 
         con_pool_size = 4 + 4
         request_kwargs = {"con_pool_size": con_pool_size}
@@ -63,6 +82,11 @@ class LajujaBotUpdater(Updater):
         self.register_handlers()
         self.restore_bot_data()
 
+        self.job_queue.run_repeating(self.audit_subscriptions,
+                                     interval=self._audit_interval,
+                                     first=self._audit_interval,
+                                     name="audit subscriptions")
+
     def register_handlers(self):
         if "MaintenanceMode" in self.config and self.config["MaintenanceMode"] == "True":
             self.dispatcher.add_handler(CommandHandler('start', self.start))
@@ -95,15 +119,17 @@ class LajujaBotUpdater(Updater):
                     bot_data[broadcaster_id]["subscribers"].append(chat_id)
                 else:
                     sub_id = self._tw_subscribe_stream_online(broadcaster_id, broadcaster_name)
-                    if sub_id:
-                        bot_data[broadcaster_id] = {"subscription_uuid": sub_id, "subscribers": [chat_id]}
+                    bot_data[broadcaster_id] = {"subscription_uuid": sub_id, "subscribers": [chat_id]}
+                    if not sub_id:
+                        self.schedule_resubscription(broadcaster_id)
         self.dispatcher.bot_data = bot_data
 
     def remove_from_bot_data(self, bot_data, chat_id, broadcaster_id):
         subscription = bot_data[broadcaster_id]
         subscription["subscribers"].remove(chat_id)
         if len(subscription["subscribers"]) == 0:
-            self._tw_unsubscribe(subscription["subscription_uuid"])
+            if subscription["subscription_uuid"]:
+                self._tw_unsubscribe(subscription["subscription_uuid"])
             bot_data.pop(broadcaster_id)
 
     def delete_chat_data(self, chat_id):
@@ -123,6 +149,164 @@ class LajujaBotUpdater(Updater):
         logger.info(info_msg)
         return
 
+    def drop_broadcaster(self, context):
+        broadcaster_id = context.job.context
+        with self._subscription_lock:
+            subscription = self.dispatcher.bot_data.pop(broadcaster_id, None)
+        if not subscription:
+            return
+        for chat_id in subscription["subscribers"]:
+            broadcaster_name = self.dispatcher.chat_data[chat_id].pop(broadcaster_id, broadcaster_id)
+            text = f"The channel {broadcaster_name} doesn't exist anymore, so you won't receive notifications about it."
+            try:
+                self.bot.send_message(chat_id=chat_id, text=text)
+            except (BadRequest, ChatMigrated, Unauthorized) as e:
+                logger.info(f"Sending a message to chat {chat_id} raised error {type(e).__name__}: {e}")
+        self.dispatcher.update_persistence()
+        logger.info(f"Removed broadcaster {broadcaster_id} from all subscriptions.")
+
+
+    def mark_subscription_broken(self, broadcaster_id, sub_id, schedule=True):
+        # only the first report about a given subscription schedules a resubscription,
+        # so that a revocation and an audit cannot both queue one
+        with self._subscription_lock:
+            subscription = self.dispatcher.bot_data.get(broadcaster_id)
+            if not subscription or subscription["subscription_uuid"] != sub_id:
+                return False
+            subscription["subscription_uuid"] = None
+        if schedule:
+            self.schedule_resubscription(broadcaster_id)
+        return True
+
+    def schedule_resubscription(self, broadcaster_id, attempt=0):
+        delay = min(RESUBSCRIBE_BASE_DELAY * 2 ** attempt, RESUBSCRIBE_MAX_DELAY)
+        # jitter keeps the retries of a bulk revocation from moving in lockstep
+        delay *= random.uniform(1, 1.5)
+        with self._subscription_lock:
+            # resubscriptions also queue behind each other, so they never come in bursts
+            now = time.monotonic()
+            start = max(now + delay, self._next_resubscription_slot)
+            self._next_resubscription_slot = start + RESUBSCRIBE_INTERVAL
+        delay = start - now
+        self.job_queue.run_once(self.resubscribe,
+                                delay,
+                                context=(broadcaster_id, attempt),
+                                name=f"resubscribe {broadcaster_id}",
+                                job_kwargs={"misfire_grace_time": None})
+        logger.info(f"Will try resubscribing to broadcaster {broadcaster_id} in {delay:.0f} seconds.")
+
+    def _set_job_event_loop(self):
+        # job threads have no event loop, but twitchAPI needs one to subscribe
+        try:
+            asyncio.get_event_loop()
+        except RuntimeError:
+            asyncio.set_event_loop(asyncio.new_event_loop())
+
+    def resubscribe(self, context):
+        broadcaster_id, attempt = context.job.context
+        subscription = self.dispatcher.bot_data.get(broadcaster_id)
+        if not subscription or subscription["subscription_uuid"]:
+            # every subscriber left in the meantime, or someone subscribed anew
+            return
+
+        self._set_job_event_loop()
+        try:
+            chat_id = subscription["subscribers"][0]
+            broadcaster_name = self.dispatcher.chat_data[chat_id][broadcaster_id]
+            sub_id = self._tw_subscribe_stream_online(broadcaster_id, broadcaster_name,
+                                                      max_attempts=1, raise_conflict=True)
+        except EventSubSubscriptionConflict:
+            # a leftover subscription still exists on twitch, the next audit deletes it
+            # and requeues this broadcaster, so there is no point in backing off here
+            self._conflicting_broadcasters.add(broadcaster_id)
+            return
+        except Exception:
+            logger.exception(f"Resubscribing to broadcaster {broadcaster_id} crashed.")
+            sub_id = None
+        if not sub_id:
+            self.schedule_resubscription(broadcaster_id, attempt + 1)
+            return
+
+        with self._subscription_lock:
+            if (self.dispatcher.bot_data.get(broadcaster_id) is subscription
+                    and not subscription["subscription_uuid"]):
+                subscription["subscription_uuid"] = sub_id
+                return
+        # every subscriber left while we were subscribing, or another job was faster
+        self._tw_unsubscribe(sub_id)
+
+    def audit_subscriptions(self, context):
+        """
+        Compare the stream.online subscriptions known to Twitch with bot_data,
+        one page at a time, and only repair the differences:
+        unhealthy or missing subscriptions are resubscribed through the backoff queue,
+        and subscriptions nobody listens to anymore are deleted.
+        """
+
+        self._set_job_event_loop()
+        audit_start = datetime.now(timezone.utc)
+        # subscriptions are created some time before their id reaches bot_data,
+        # and the clocks of twitch and this host may differ
+        orphan_deadline = audit_start - timedelta(seconds=self._audit_interval)
+        callback_url = self._wh_handler.get_subscription_callback_url()
+        bot_data = self.dispatcher.bot_data
+        expected = {subscription["subscription_uuid"]: broadcaster_id
+                    for broadcaster_id, subscription in list(bot_data.items())
+                    if subscription["subscription_uuid"]}
+        conflicting = set(self._conflicting_broadcasters)
+
+        seen = set()
+        broken = orphans = 0
+        cursor = None
+        while True:
+            page, cursor = self._wh_handler.get_stream_online_subscriptions_page(cursor)
+            if page is None:
+                logger.error("Aborted the subscription audit, it will be run again later.")
+                return
+            for remote in page:
+                sub_id = remote["id"]
+                broadcaster_id = remote["condition"]["broadcaster_user_id"]
+                subscription = bot_data.get(broadcaster_id)
+                if subscription and subscription["subscription_uuid"] == sub_id:
+                    seen.add(sub_id)
+                    # the subscription must be gone from twitch before we can subscribe again
+                    if (remote["status"] not in HEALTHY_SUBSCRIPTION_STATUSES
+                            and self._tw_unsubscribe(sub_id)):
+                        broken += 1
+                        self.mark_subscription_broken(broadcaster_id, sub_id, schedule=False)
+                    continue
+                if remote["transport"]["callback"] != callback_url:
+                    # this subscription belongs to another deployment of the app
+                    continue
+                created_at = datetime.fromisoformat(remote["created_at"][:-1]+"+00:00")
+                leftover = (broadcaster_id in conflicting
+                            and subscription and not subscription["subscription_uuid"])
+                if leftover or created_at < orphan_deadline:
+                    if self._tw_unsubscribe(sub_id):
+                        orphans += 1
+
+            if not cursor:
+                break
+
+        missing = [sub_id for sub_id in expected if sub_id not in seen]
+        for sub_id in missing:
+            self.mark_subscription_broken(expected[sub_id], sub_id, schedule=False)
+        self._conflicting_broadcasters -= conflicting
+
+        # requeue every broken subscription without a pending resubscription,
+        # including those whose backoff chain was interrupted
+        pending = {job.name for job in self.job_queue.jobs()}
+        stalled = [broadcaster_id for broadcaster_id, subscription in list(bot_data.items())
+                   if not subscription["subscription_uuid"]
+                   and f"resubscribe {broadcaster_id}" not in pending]
+        for broadcaster_id in stalled:
+            self.schedule_resubscription(broadcaster_id)
+
+        logger.info(
+            f"Audited {len(expected)} subscriptions: {broken} unhealthy, "
+            f"{len(missing)} missing, {orphans} orphaned, {len(stalled)} requeued."
+        )
+
 
     def _tw_get_broadcaster_id(self, broadcaster_name):
         return self._wh_handler.get_broadcaster_id_clean(broadcaster_name)
@@ -133,15 +317,18 @@ class LajujaBotUpdater(Updater):
     def _tw_get_followed_channels(self, user_id):
         return self._wh_handler.get_followed_channels(user_id)
 
-    def _tw_subscribe_stream_online(self, broadcaster_id, broadcaster_name):
+    def _tw_subscribe_stream_online(self, broadcaster_id, broadcaster_name,
+                                    max_attempts=5, raise_conflict=False):
         return self._wh_handler.listen_stream_online_clean(
             broadcaster_id,
             broadcaster_name,
-            self.callback_stream_changed
+            self.callback_stream_changed,
+            max_attempts=max_attempts,
+            raise_conflict=raise_conflict
         )
 
     def _tw_unsubscribe(self, sub_id):
-        self._wh_handler.hook.unsubscribe_topic(sub_id)
+        return self._wh_handler.unsubscribe_clean(sub_id)
 
 
     def _sub_by_id(self, update, context, broadcaster_id, broadcaster_name):
@@ -176,6 +363,19 @@ class LajujaBotUpdater(Updater):
     async def callback_stream_changed(self, data):
 
         sub_id = data["subscription"]["id"]
+        if "event" not in data:
+            # this is a revocation notification: twitch already deleted the subscription
+            broadcaster_id = data["subscription"]["condition"]["broadcaster_user_id"]
+            status = data["subscription"]["status"]
+            logger.info(f"Twitch revoked subscription {sub_id} to broadcaster {broadcaster_id} ({status})")
+            if status == "user_removed":
+                # the broadcaster account is gone, resubscribing would never succeed;
+                # chat_data is left to the job queue rather than this webhook thread
+                self.job_queue.run_once(self.drop_broadcaster, 0, context=broadcaster_id,
+                                        name=f"drop {broadcaster_id}")
+            else:
+                self.mark_subscription_broken(broadcaster_id, sub_id)
+            return
         event = data["event"]
 
         started_at = event["started_at"]
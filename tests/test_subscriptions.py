@@ -0,0 +1,185 @@
+import asyncio
+import threading
+import unittest
+
+from collections import defaultdict
+from types import SimpleNamespace
+from unittest import mock
+
+from twitchAPI import EventSubSubscriptionConflict
+
+from bot import LajujaBotUpdater
+from twitch import TwitchWebhookHandler
+
+
+CALLBACK_URL = "https://mydomain.tld/lajujabot-webhook"
+OLD = "2021-01-01T00:00:00.123456789Z"
+
+
+def remote_subscription(sub_id, broadcaster_id, status="enabled",
+                        created_at=OLD, callback=CALLBACK_URL + "/callback"):
+    return {"id": sub_id,
+            "status": status,
+            "type": "stream.online",
+            "condition": {"broadcaster_user_id": broadcaster_id},
+            "transport": {"method": "webhook", "callback": callback},
+            "created_at": created_at}
+
+
+def revocation(sub_id, broadcaster_id, status):
+    return {"subscription": {"id": sub_id,
+                             "status": status,
+                             "type": "stream.online",
+                             "condition": {"broadcaster_user_id": broadcaster_id}}}
+
+
+class SubscriptionRepairTest(unittest.TestCase):
+
+    def setUp(self):
+        # a TwitchWebhookHandler whose calls to the Twitch API are mocked
+        self.wh_handler = TwitchWebhookHandler.__new__(TwitchWebhookHandler)
+        self.wh_handler.hook = mock.Mock(callback_url=CALLBACK_URL)
+        self.wh_handler.hook.unsubscribe_topic.return_value = True
+        self.wh_handler.get_eventsub_subscriptions = mock.Mock()
+
+        self.updater = LajujaBotUpdater.__new__(LajujaBotUpdater)
+        self.updater.config = {"CallbackURL": CALLBACK_URL}
+        self.updater._wh_handler = self.wh_handler
+        self.updater._subscription_lock = threading.Lock()
+        self.updater._next_resubscription_slot = 0
+        self.updater._conflicting_broadcasters = set()
+        self.updater._audit_interval = 300
+        self.updater.bot = mock.Mock()
+        self.updater.job_queue = mock.Mock()
+        self.updater.job_queue.jobs.return_value = ()
+        self.updater.dispatcher = mock.Mock(bot_data={}, chat_data=defaultdict(dict))
+
+    def subscribe(self, broadcaster_id, broadcaster_name, sub_id, chat_id=1):
+        self.updater.dispatcher.chat_data[chat_id][broadcaster_id] = broadcaster_name
+        self.updater.dispatcher.bot_data[broadcaster_id] = {"subscription_uuid": sub_id,
+                                                            "subscribers": [chat_id]}
+
+    def scheduled(self, callback):
+        return [c.kwargs["context"]
+                for c in self.updater.job_queue.run_once.call_args_list
+                if c.args[0] == callback]
+
+    def unsubscribed(self):
+        return [c.args[0] for c in self.wh_handler.hook.unsubscribe_topic.call_args_list]
+
+    def test_revocation_schedules_resubscription(self):
+        self.subscribe("42", "streamer", "sub-1")
+        asyncio.run(self.updater.callback_stream_changed(
+            revocation("sub-1", "42", "authorization_revoked")))
+
+        self.assertIsNone(self.updater.dispatcher.bot_data["42"]["subscription_uuid"])
+        self.assertEqual(self.scheduled(self.updater.resubscribe), [("42", 0)])
+        self.assertEqual(self.scheduled(self.updater.drop_broadcaster), [])
+
+    def test_user_removed_revocation_drops_broadcaster(self):
+        self.subscribe("42", "streamer", "sub-1")
+        asyncio.run(self.updater.callback_stream_changed(
+            revocation("sub-1", "42", "user_removed")))
+
+        self.assertEqual(self.scheduled(self.updater.resubscribe), [])
+        self.assertEqual(self.scheduled(self.updater.drop_broadcaster), ["42"])
+
+        self.updater.drop_broadcaster(mock.Mock(job=mock.Mock(context="42")))
+        self.assertNotIn("42", self.updater.dispatcher.bot_data)
+        self.assertEqual(self.updater.dispatcher.chat_data[1], {})
+        self.updater.bot.send_message.assert_called_once()
+        self.updater.dispatcher.update_persistence.assert_called_once()
+
+    def test_audit_repairs_differences_across_pages(self):
+        self.subscribe("1", "healthy", "sub-1")
+        self.subscribe("2", "unhealthy", "sub-2")
+        self.subscribe("3", "missing", "sub-3")
+        pages = {
+            None: {"data": [remote_subscription("sub-1", "1"),
+                            remote_subscription("sub-2", "2", status="notification_failures_exceeded")],
+                   "pagination": {"cursor": "page-2"}},
+            "page-2": {"data": [remote_subscription("sub-orphan", "9"),
+                                remote_subscription("sub-recent", "8", created_at="2999-01-01T00:00:00Z"),
+                                remote_subscription("sub-foreign", "7", callback="https://other.tld/callback")],
+                       "pagination": {}},
+        }
+        self.wh_handler.get_eventsub_subscriptions.side_effect = \
+            lambda sub_type, after: pages[after]
+
+        self.updater.audit_subscriptions(mock.Mock())
+
+        self.assertEqual(self.unsubscribed(), ["sub-2", "sub-orphan"])
+        bot_data = self.updater.dispatcher.bot_data
+        self.assertEqual(bot_data["1"]["subscription_uuid"], "sub-1")
+        self.assertIsNone(bot_data["2"]["subscription_uuid"])
+        self.assertIsNone(bot_data["3"]["subscription_uuid"])
+        self.assertEqual(sorted(self.scheduled(self.updater.resubscribe)), [("2", 0), ("3", 0)])
+
+    def test_audit_keeps_subscription_when_delete_fails(self):
+        self.subscribe("2", "unhealthy", "sub-2")
+        self.wh_handler.hook.unsubscribe_topic.return_value = False
+        self.wh_handler.get_eventsub_subscriptions.return_value = {
+            "data": [remote_subscription("sub-2", "2", status="notification_failures_exceeded")],
+            "pagination": {}}
+
+        self.updater.audit_subscriptions(mock.Mock())
+
+        self.assertEqual(self.updater.dispatcher.bot_data["2"]["subscription_uuid"], "sub-2")
+        self.assertEqual(self.scheduled(self.updater.resubscribe), [])
+
+    def test_audit_requeues_stalled_subscriptions_once(self):
+        self.subscribe("4", "stalled", None)
+        self.subscribe("5", "pending", None)
+        self.updater.job_queue.jobs.return_value = (SimpleNamespace(name="resubscribe 5"),)
+        self.wh_handler.get_eventsub_subscriptions.return_value = {"data": [], "pagination": {}}
+
+        self.updater.audit_subscriptions(mock.Mock())
+
+        self.assertEqual(self.scheduled(self.updater.resubscribe), [("4", 0)])
+        self.updater.job_queue.jobs.assert_called_once()
+
+    def test_resubscribe_conflict_is_repaired_by_audit(self):
+        self.subscribe("6", "conflicting", None)
+        self.wh_handler.hook.listen_stream_online.side_effect = EventSubSubscriptionConflict("conflict")
+
+        self.updater.resubscribe(mock.Mock(job=mock.Mock(context=("6", 0))))
+        self.assertEqual(self.scheduled(self.updater.resubscribe), [])
+
+        self.wh_handler.get_eventsub_subscriptions.return_value = {
+            "data": [remote_subscription("sub-leftover", "6", created_at="2999-01-01T00:00:00Z")],
+            "pagination": {}}
+        self.updater.audit_subscriptions(mock.Mock())
+
+        self.assertEqual(self.unsubscribed(), ["sub-leftover"])
+        self.assertEqual(self.scheduled(self.updater.resubscribe), [("6", 0)])
+        self.assertEqual(self.updater._conflicting_broadcasters, set())
+
+    def test_resubscribe_from_job_thread(self):
+        self.subscribe("42", "streamer", None)
+
+        def listen_stream_online(broadcaster_id, callback):
+            # twitchAPI waits for the subscription challenge on the thread's event loop
+            asyncio.get_event_loop().run_until_complete(asyncio.sleep(0))
+            return "sub-new"
+        self.wh_handler.hook.listen_stream_online.side_effect = listen_stream_online
+
+        job_thread = threading.Thread(target=self.updater.resubscribe,
+                                      args=(mock.Mock(job=mock.Mock(context=("42", 0))),))
+        job_thread.start()
+        job_thread.join()
+
+        self.assertEqual(self.updater.dispatcher.bot_data["42"]["subscription_uuid"], "sub-new")
+
+    def test_resubscribe_failure_backs_off_with_jitter(self):
+        self.subscribe("42", "streamer", None)
+        self.wh_handler.hook.listen_stream_online.side_effect = RuntimeError("boom")
+
+        self.updater.resubscribe(mock.Mock(job=mock.Mock(context=("42", 2))))
+
+        self.assertEqual(self.scheduled(self.updater.resubscribe), [("42", 3)])
+        delay = self.updater.job_queue.run_once.call_args.args[1]
+        self.assertTrue(240 <= delay <= 360)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -79,10 +79,23 @@ class TwitchWebhookHandler(Twitch):
         logger.info(info_msg)
         return followed_channels
 
-    def listen_stream_online_clean(self, broadcaster_id, broadcaster_name, callback):
+    def get_stream_online_subscriptions_page(self, after=None):
+        try:
+            res = self.get_eventsub_subscriptions(sub_type="stream.online", after=after)
+        except (TwitchAPIException, UnauthorizedException,
+                TwitchAuthorizationException, TwitchBackendException,
+                requests.exceptions.ConnectionError) as e:
+            error_msg = "Failed to list stream.online subscriptions with error {}: '{}'"
+            error_msg = error_msg.format(type(e).__name__, e)
+            logger.error(error_msg)
+            return None, None
+        cursor = res.get("pagination", {}).get("cursor")
+        return res["data"], cursor
+
+    def listen_stream_online_clean(self, broadcaster_id, broadcaster_name, callback,
+                                   max_attempts=5, raise_conflict=False):
         hook_success = False
         attempt = 0
-        max_attempts = 5
         while True:
             attempt += 1
             try:
@@ -96,6 +109,9 @@ class TwitchWebhookHandler(Twitch):
                 error_msg = "Subscription to broadcaster {} (id {}) failed with error {}: '{}'"
                 error_msg = error_msg.format(broadcaster_name, broadcaster_id, type(e).__name__, e)
                 logger.error(error_msg)
+                if raise_conflict and isinstance(e, EventSubSubscriptionConflict):
+                    # retrying is pointless until the existing subscription is deleted
+                    raise
                 if attempt == max_attempts:
                     break
                 # retry after 5 seconds on first error, then after 10 seconds, etc.
@@ -116,6 +132,24 @@ class TwitchWebhookHandler(Twitch):
         logger.info(info_msg)
         return uuid
 
+    def get_subscription_callback_url(self):
+        # twitchAPI registers every subscription with this suffix
+        return f"{self.hook.callback_url}/callback"
+
+    def unsubscribe_clean(self, sub_id):
+        try:
+            success = self.hook.unsubscribe_topic(sub_id)
+        except (TwitchAPIException, UnauthorizedException,
+                TwitchAuthorizationException, TwitchBackendException,
+                requests.exceptions.ConnectionError) as e:
+            error_msg = "Failed to delete subscription {} with error {}: '{}'"
+            error_msg = error_msg.format(sub_id, type(e).__name__, e)
+            logger.error(error_msg)
+            return False
+        if not success:
+            logger.error(f"Failed to delete subscription {sub_id}")
+        return success
+
     def __del__(self):
         if self.hook:
             self.hook.stop()